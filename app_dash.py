@@ -1,13 +1,17 @@
 import os
 import json
 from datetime import datetime
+from functools import lru_cache
 
 import dash
 from dash import dcc, html
 import dash_bootstrap_components as dbc
+from flask import jsonify
+from flask_compress import Compress
 
-from chat_db import init_db, list_chats, create_chat
+from chat_db import init_db, get_chats_cached, create_chat
 from callbacks.chat_callbacks import register_chat_callbacks
+from rag_backend import cache_stats
 
 # ---------- App & Theme ----------
 external_stylesheets = [dbc.themes.CYBORG]
@@ -18,6 +22,16 @@ app = dash.Dash(
 )
 server = app.server
 
+# Callback responses are verbose JSON component trees; gzip/brotli them
+server.config["COMPRESS_MIMETYPES"] = [
+    "application/json",
+    "text/html",
+    "text/css",
+    "application/javascript",
+]
+server.config["COMPRESS_LEVEL"] = 6
+Compress(server)
+
 # ---------- Styles ----------
 CHAT_BUBBLE_CSS = {
     "assistant": {
@@ -42,19 +56,42 @@ CHAT_BUBBLE_CSS = {
     },
 }
 
+# Hoisted for messages_view (hot path on long histories)
+_USER_STYLE = CHAT_BUBBLE_CSS["user"]
+_ASSIST_STYLE = CHAT_BUBBLE_CSS["assistant"]
+_ROW_USER = "d-flex justify-content-end"
+_ROW_ASSIST = "d-flex justify-content-start"
+_PREVIEW_STYLE = {"maxWidth": "240px", "borderRadius": "12px", "marginBottom": "8px"}
+
 
 def chat_item(chat, active_id):
-    """One row in the chat history list (left sidebar)."""
-    cid = chat.get("id")
-    cid_str = str(cid)
+    """
+    One row in the chat history list (left sidebar).
+    Used for the first paint; later refreshes are rendered by assets/sidebar.js,
+    which builds the same markup.
+    """
+    cid_str = str(chat.get("id"))
     is_active = str(active_id) == cid_str
+    return _chat_item_cached(cid_str, chat.get("title", "Chat"), is_active)
+
 
-    return dbc.ListGroupItem(
+@lru_cache(maxsize=2048)
+def _chat_item_cached(cid_str, title, is_active):
+    """
+    Build the sidebar row for (id, title, active).
+    The row only depends on these three values, so identical rows are
+    reused across callbacks. Do not mutate the returned component.
+
+    Clicks are not wired per row: elements carry data-chat-id / data-action
+    and a single delegated listener (assets/sidebar.js) reports them through
+    the "sidebar-click" store.
+    """
+    return html.Div(
         [
             html.Div(
                 [
                     html.Div(
-                        chat.get("title", "Chat"),
+                        title,
                         className="fw-semibold text-truncate",
                         style={"maxWidth": "180px"},
                     ),
@@ -65,13 +102,15 @@ def chat_item(chat, active_id):
                         class_name="ms-auto",
                         toggleClassName="btn-sm",
                         children=[
-                            dbc.DropdownMenuItem(
+                            html.Button(
                                 "Rename",
-                                id={"type": "chat-action", "key": f"{cid_str}|rename"},
+                                className="dropdown-item",
+                                **{"data-chat-id": cid_str, "data-action": "rename"},
                             ),
-                            dbc.DropdownMenuItem(
+                            html.Button(
                                 "Delete",
-                                id={"type": "chat-action", "key": f"{cid_str}|delete"},
+                                className="dropdown-item",
+                                **{"data-chat-id": cid_str, "data-action": "delete"},
                             ),
                         ],
                         direction="down",
@@ -80,254 +119,299 @@ def chat_item(chat, active_id):
                 className="d-flex align-items-center justify-content-between",
             ),
         ],
-        id={"type": "chat-select", "chat_id": cid_str},
-        action=True,
-        active=is_active,
-        class_name="rounded-3",
-        style={"background": "rgba(255,255,255,0.05)" if is_active else "transparent"},
+        className="list-group-item list-group-item-action rounded-3" + (" active" if is_active else ""),
+        style={
+            "cursor": "pointer",
+            "background": "rgba(255,255,255,0.05)" if is_active else "transparent",
+        },
+        **{"data-chat-id": cid_str, "data-action": "select"},
     )
 
 
-def messages_view(messages):
-    """Render list of messages to chat bubbles."""
-    ui = []
-    for m in messages:
-        role = m["role"]
-        is_user = role == "user"
-        bubble_style = CHAT_BUBBLE_CSS["user" if is_user else "assistant"]
-        row_cls = "d-flex justify-content-end" if is_user else "d-flex justify-content-start"
-
-        content_children = [html.Div(m["content"])]
-        meta = m.get("meta") or {}
-
-        if meta.get("image_preview"):
-            content_children.insert(
-                0,
-                html.Img(
-                    src=meta["image_preview"],
-                    style={"maxWidth": "240px", "borderRadius": "12px", "marginBottom": "8px"},
-                ),
-            )
-
-        if meta.get("tags"):
-            content_children.append(
-                html.Div(
-                    [html.Span(f"#{t}", className="badge bg-secondary me-1") for t in meta["tags"]],
-                    className="mt-2",
-                )
-            )
+def _bubble_children(m):
+    """Image preview (optional) + text + tags (optional) for one message."""
+    meta = m.get("meta")
+    if not meta:
+        return [html.Div(m["content"])]
 
-        ui.append(
+    children = []
+    if meta.get("image_preview"):
+        children.append(html.Img(src=meta["image_preview"], style=_PREVIEW_STYLE))
+    children.append(html.Div(m["content"]))
+    if meta.get("tags"):
+        children.append(
             html.Div(
-                [html.Div(content_children, style=bubble_style)],
-                className=row_cls,
+                [html.Span(f"#{t}", className="badge bg-secondary me-1") for t in meta["tags"]],
+                className="mt-2",
             )
         )
-    return ui
+    return children
 
 
-# ---------- Layout ----------
-app.layout = dbc.Container(
-    fluid=True,
-    children=[
-        dcc.Store(id="active-chat-id"),
-        dcc.Store(id="rename-target-id"),
-        dcc.Store(id="upload-image-b64"),
-        dcc.Interval(id="tick", interval=500, n_intervals=0, max_intervals=1),
-
-        dbc.Row(
+def _render_one(m):
+    """One chat bubble row; shared by full renders and Patch appends."""
+    is_user = m["role"] == "user"
+    return html.Div(
+        [html.Div(_bubble_children(m), style=_USER_STYLE if is_user else _ASSIST_STYLE)],
+        className=_ROW_USER if is_user else _ROW_ASSIST,
+    )
+
+
+def messages_view(messages):
+    """Render list of messages to chat bubbles."""
+    return [_render_one(m) for m in messages]
+
+
+# ---------- Static layout pieces ----------
+# Built once at import and shared by every serve_layout() call; never mutated.
+
+# Composer
+_COMPOSER_ROW = dbc.Row(
+    [
+        dbc.Col(
             [
-                # Sidebar
-                dbc.Col(
-                    width=3,
-                    children=[
-                        html.Div(
-                            [
-                                html.Div(
-                                    [
-                                        html.H4("Chats", className="mb-0"),
-                                        dbc.Button(
-                                            "➕ New chat",
-                                            id="new-chat",
-                                            size="sm",
-                                            color="primary",
-                                            className="ms-auto",
-                                        ),
-                                    ],
-                                    className="d-flex align-items-center justify-content-between mb-3",
-                                ),
-                                dbc.ListGroup(
-                                    id="chat-list",
-                                    flush=True,
-                                    class_name="rounded-3",
-                                ),
-                            ],
-                            style={
-                                "height": "95vh",
-                                "overflowY": "auto",
-                                "padding": "16px",
-                                "background": "rgba(255,255,255,0.03)",
-                                "borderRight": "1px solid rgba(255,255,255,0.08)",
-                            },
-                        )
-                    ],
-                    class_name="px-0",
-                ),
-
-                # Main area
-                dbc.Col(
-                    width=9,
-                    children=[
-                        html.Div(
-                            [
-                                html.Div(
-                                    [html.H4(id="chat-title", className="mb-0")],
-                                    className="d-flex align-items-center justify-content-between mb-2",
-                                ),
-                                dbc.Card(
-                                    [
-                                        dbc.CardBody(
-                                            dcc.Loading(
-                                                id="loading-chat",
-                                                type="circle",
-                                                children=html.Div(
-                                                    id="chat-messages",
-                                                    style={
-                                                        "minHeight": "65vh",
-                                                        "overflowY": "auto",
-                                                        "padding": "8px",
-                                                    },
-                                                ),
-                                            )
-                                        )
-                                    ],
-                                    class_name="mb-3 rounded-4",
-                                    style={
-                                        "background": "rgba(255,255,255,0.03)",
-                                        "border": "1px solid rgba(255,255,255,0.08)",
-                                    },
-                                ),
-                                # Composer
-                                dbc.Row(
-                                    [
-                                        dbc.Col(
-                                            [
-                                                dbc.Input(
-                                                    id="user-input",
-                                                    placeholder="Type your message...",
-                                                    type="text",
-                                                )
-                                            ],
-                                            width=9,
-                                        ),
-                                        dbc.Col(
-                                            [
-                                                dbc.Button(
-                                                    "Send",
-                                                    id="send-btn",
-                                                    color="success",
-                                                    className="w-100",
-                                                )
-                                            ],
-                                            width=3,
-                                        ),
-                                    ],
-                                    class_name="g-2",
-                                ),
-                                # Image upload row
-                                html.Div(className="mt-3"),
-                                dbc.Row(
-                                    [
-                                        dbc.Col(
-                                            [
-                                                dcc.Upload(
-                                                    id="image-upload",
-                                                    children=html.Div(
-                                                        ["Drag & drop or ", html.A("select an image")]
-                                                    ),
-                                                    multiple=False,
-                                                    style={
-                                                        "width": "100%",
-                                                        "height": "70px",
-                                                        "lineHeight": "70px",
-                                                        "borderWidth": "1px",
-                                                        "borderStyle": "dashed",
-                                                        "borderRadius": "10px",
-                                                        "textAlign": "center",
-                                                        "background": "rgba(255,255,255,0.02)",
-                                                    },
-                                                )
-                                            ],
-                                            width=9,
-                                        ),
-                                        dbc.Col(
-                                            [
-                                                dbc.Button(
-                                                    "Generate Caption",
-                                                    id="caption-btn",
-                                                    color="info",
-                                                    className="w-100",
-                                                )
-                                            ],
-                                            width=3,
-                                        ),
-                                    ],
-                                    class_name="g-2",
-                                    align="center",
-                                ),
-                            ],
-                            style={"height": "95vh", "padding": "16px"},
-                        )
-                    ],
-                    class_name="px-0",
-                ),
-            ]
+                dbc.Input(
+                    id="user-input",
+                    placeholder="Type your message...",
+                    type="text",
+                )
+            ],
+            width=9,
         ),
-
-        # Rename modal
-        dbc.Modal(
+        dbc.Col(
             [
-                dbc.ModalHeader("Rename chat"),
-                dbc.ModalBody(dbc.Input(id="rename-input", placeholder="Enter new title...")),
-                dbc.ModalFooter(
-                    [
-                        dbc.Button("Cancel", id="rename-cancel", color="secondary"),
-                        dbc.Button("Save", id="rename-save", color="primary"),
-                    ]
-                ),
+                dbc.Button(
+                    "Send",
+                    id="send-btn",
+                    color="success",
+                    className="w-100",
+                )
             ],
-            id="rename-modal",
-            is_open=False,
+            width=3,
         ),
+    ],
+    class_name="g-2",
+)
 
-        # Delete modal
-        dbc.Modal(
+# Image upload row
+_UPLOAD_ROW = dbc.Row(
+    [
+        dbc.Col(
+            [
+                dcc.Upload(
+                    id="image-upload",
+                    children=html.Div(
+                        ["Drag & drop or ", html.A("select an image")]
+                    ),
+                    multiple=False,
+                    style={
+                        "width": "100%",
+                        "height": "70px",
+                        "lineHeight": "70px",
+                        "borderWidth": "1px",
+                        "borderStyle": "dashed",
+                        "borderRadius": "10px",
+                        "textAlign": "center",
+                        "background": "rgba(255,255,255,0.02)",
+                    },
+                )
+            ],
+            width=9,
+        ),
+        dbc.Col(
             [
-                dbc.ModalHeader("Delete chat"),
-                dbc.ModalBody("Are you sure you want to delete this chat?"),
-                dbc.ModalFooter(
-                    [
-                        dbc.Button("Cancel", id="delete-cancel", color="secondary"),
-                        dbc.Button("Delete", id="delete-confirm", color="danger"),
-                    ]
-                ),
+                dbc.Button(
+                    "Generate Caption",
+                    id="caption-btn",
+                    color="info",
+                    className="w-100",
+                )
             ],
-            id="delete-modal",
-            is_open=False,
+            width=3,
         ),
     ],
+    class_name="g-2",
+    align="center",
 )
 
-# ---------- Init DB & default chat ----------
+# Rename modal
+_RENAME_MODAL = dbc.Modal(
+    [
+        dbc.ModalHeader("Rename chat"),
+        dbc.ModalBody(dbc.Input(id="rename-input", placeholder="Enter new title...")),
+        dbc.ModalFooter(
+            [
+                dbc.Button("Cancel", id="rename-cancel", color="secondary"),
+                dbc.Button("Save", id="rename-save", color="primary"),
+            ]
+        ),
+    ],
+    id="rename-modal",
+    is_open=False,
+)
+
+# Delete modal
+_DELETE_MODAL = dbc.Modal(
+    [
+        dbc.ModalHeader("Delete chat"),
+        dbc.ModalBody("Are you sure you want to delete this chat?"),
+        dbc.ModalFooter(
+            [
+                dbc.Button("Cancel", id="delete-cancel", color="secondary"),
+                dbc.Button("Delete", id="delete-confirm", color="danger"),
+            ]
+        ),
+    ],
+    id="delete-modal",
+    is_open=False,
+)
+
+
+# ---------- Layout ----------
+def serve_layout():
+    """
+    Built on every page load, so the sidebar and the active chat arrive with
+    the page instead of a follow-up callback round trip.
+    """
+    chats = get_chats_cached()
+    if not chats:
+        create_chat("New chat")
+        chats = get_chats_cached()
+    first_id = chats[0]["id"]
+    initial_items = [chat_item(c, first_id) for c in chats]
+
+    return dbc.Container(
+        fluid=True,
+        children=[
+            dcc.Store(id="active-chat-id", data=first_id),
+            dcc.Store(id="chats-meta"),
+            dcc.Store(id="sidebar-click"),
+            dcc.Store(id="refresh-pending"),
+            dcc.Interval(id="refresh-tick", interval=100, n_intervals=0, disabled=True),
+            dcc.Store(id="pending-reply"),
+            dcc.Store(id="pending-job", data=[]),
+            dcc.Interval(id="job-poll", interval=250, n_intervals=0, disabled=True),
+            # messages of jobs that just finished (written by poll_jobs only on completion)
+            dcc.Store(id="finished-messages"),
+            dcc.Store(id="rename-target-id"),
+            dcc.Store(id="oldest-msg-id"),
+            dcc.Store(id="upload-image-b64"),
+
+            dbc.Row(
+                [
+                    # Sidebar
+                    dbc.Col(
+                        width=3,
+                        children=[
+                            html.Div(
+                                [
+                                    html.Div(
+                                        [
+                                            html.H4("Chats", className="mb-0"),
+                                            dbc.Button(
+                                                "➕ New chat",
+                                                id="new-chat",
+                                                size="sm",
+                                                color="primary",
+                                                className="ms-auto",
+                                            ),
+                                        ],
+                                        className="d-flex align-items-center justify-content-between mb-3",
+                                    ),
+                                    dbc.ListGroup(
+                                        id="chat-list",
+                                        children=initial_items,
+                                        flush=True,
+                                        class_name="rounded-3",
+                                    ),
+                                ],
+                                style={
+                                    "height": "95vh",
+                                    "overflowY": "auto",
+                                    "padding": "16px",
+                                    "background": "rgba(255,255,255,0.03)",
+                                    "borderRight": "1px solid rgba(255,255,255,0.08)",
+                                },
+                            )
+                        ],
+                        class_name="px-0",
+                    ),
+
+                    # Main area
+                    dbc.Col(
+                        width=9,
+                        children=[
+                            html.Div(
+                                [
+                                    html.Div(
+                                        [html.H4(id="chat-title", className="mb-0")],
+                                        className="d-flex align-items-center justify-content-between mb-2",
+                                    ),
+                                    dbc.Card(
+                                        [
+                                            dbc.CardBody(
+                                                [
+                                                    dbc.Button(
+                                                        "Load older messages",
+                                                        id="load-older",
+                                                        size="sm",
+                                                        color="link",
+                                                        className="d-block mx-auto",
+                                                        style={"display": "none"},
+                                                    ),
+                                                    dcc.Loading(
+                                                        id="loading-chat",
+                                                        type="circle",
+                                                        children=html.Div(
+                                                            id="chat-messages",
+                                                            style={
+                                                                "minHeight": "65vh",
+                                                                "overflowY": "auto",
+                                                                "padding": "8px",
+                                                            },
+                                                        ),
+                                                    ),
+                                                ]
+                                            )
+                                        ],
+                                        class_name="mb-3 rounded-4",
+                                        style={
+                                            "background": "rgba(255,255,255,0.03)",
+                                            "border": "1px solid rgba(255,255,255,0.08)",
+                                        },
+                                    ),
+                                    html.Div(id="chat-status", className="text-muted small mb-2"),
+                                    _COMPOSER_ROW,
+                                    # Image upload row
+                                    html.Div(className="mt-3"),
+                                    _UPLOAD_ROW,
+                                ],
+                                style={"height": "95vh", "padding": "16px"},
+                            )
+                        ],
+                        class_name="px-0",
+                    ),
+                ]
+            ),
+
+            _RENAME_MODAL,
+            _DELETE_MODAL,
+        ],
+    )
+
+
+# ---------- Init DB ----------
 init_db()
-existing = list_chats()
-if not existing:
-    first_id = create_chat("New chat")
-else:
-    first_id = existing[0]["id"]
+app.layout = serve_layout
 
 # ---------- Register callbacks ----------
-register_chat_callbacks(app, chat_item, messages_view)
+register_chat_callbacks(app, messages_view)
+
+
+@server.route("/cache-stats")
+def cache_stats_route():
+    """RAG cache hit/miss counters, e.g. curl http://127.0.0.1:8050/cache-stats"""
+    return jsonify(cache_stats())
 
 
 if __name__ == "__main__":
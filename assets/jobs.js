@@ -0,0 +1,24 @@
+// assets/jobs.js
+// Client-side state of the background-job poller (loaded automatically by Dash).
+// "job-poll" runs and the status line shows exactly while the "pending-job"
+// store holds jobs. Deriving both from the store (instead of each server
+// callback setting them) means a poll response computed from an older copy of
+// the store can't switch polling off after a new job was added.
+(function () {
+    var STATUS = {
+        reply: "Thinking…",
+        caption: "Generating caption…",
+    };
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        jobs: {
+            pollState: function (jobs) {
+                if (!jobs || !jobs.length) {
+                    return [true, ""];
+                }
+                var last = jobs[jobs.length - 1];
+                return [false, STATUS[last.kind] || "Working…"];
+            },
+        },
+    });
+})();
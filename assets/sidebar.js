@@ -0,0 +1,96 @@
+// assets/sidebar.js
+// Client-side renderer for the chat sidebar (loaded automatically by Dash).
+// The server only sends [{id, title, active}] through the "chats-meta" store;
+// rows are built here and must stay in sync with chat_item() in app_dash.py.
+//
+// Clicks are handled by one delegated listener instead of a pattern-matching
+// callback per row: elements carry data-chat-id / data-action and the
+// listener writes {chat_id, action, ts} to the "sidebar-click" store, with
+// chat_id already parsed to a number so the server callbacks use it as is.
+(function () {
+    function dbc(type, props) {
+        return { type: type, namespace: "dash_bootstrap_components", props: props };
+    }
+
+    function html(type, props) {
+        return { type: type, namespace: "dash_html_components", props: props };
+    }
+
+    function menuItem(label, cid, action) {
+        return html("Button", {
+            children: label,
+            className: "dropdown-item",
+            "data-chat-id": cid,
+            "data-action": action,
+        });
+    }
+
+    function chatRow(chat) {
+        var cid = String(chat.id);
+        var isActive = !!chat.active;
+
+        return html("Div", {
+            className: "list-group-item list-group-item-action rounded-3" + (isActive ? " active" : ""),
+            style: {
+                cursor: "pointer",
+                background: isActive ? "rgba(255,255,255,0.05)" : "transparent",
+            },
+            "data-chat-id": cid,
+            "data-action": "select",
+            children: [
+                html("Div", {
+                    className: "d-flex align-items-center justify-content-between",
+                    children: [
+                        html("Div", {
+                            children: chat.title || "Chat",
+                            className: "fw-semibold text-truncate",
+                            style: { maxWidth: "180px" },
+                        }),
+                        dbc("DropdownMenu", {
+                            label: "⋮",
+                            size: "sm",
+                            color: "secondary",
+                            class_name: "ms-auto",
+                            toggleClassName: "btn-sm",
+                            direction: "down",
+                            children: [
+                                menuItem("Rename", cid, "rename"),
+                                menuItem("Delete", cid, "delete"),
+                            ],
+                        }),
+                    ],
+                }),
+            ],
+        });
+    }
+
+    // One listener for every row, present and future.
+    document.addEventListener("click", function (event) {
+        var el = event.target.closest && event.target.closest("[data-chat-id][data-action]");
+        if (!el || !window.dash_clientside || !window.dash_clientside.set_props) {
+            return;
+        }
+        var chatId = Number(el.dataset.chatId);
+        if (!Number.isInteger(chatId)) {
+            return;
+        }
+        window.dash_clientside.set_props("sidebar-click", {
+            data: {
+                chat_id: chatId,
+                action: el.dataset.action,
+                ts: Date.now(), // repeated clicks on the same row still count
+            },
+        });
+    });
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        sidebar: {
+            render: function (chats) {
+                if (!chats) {
+                    return window.dash_clientside.no_update;
+                }
+                return chats.map(chatRow);
+            },
+        },
+    });
+})();
@@ -1,52 +1,186 @@
 # callbacks/chat_callbacks.py
 
-from datetime import datetime
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from uuid import uuid4
 
-from dash import Input, Output, State, ALL, ctx, no_update
+from dash import Input, Output, State, ClientsideFunction, Patch, ctx, no_update
 import dash
 
 from chat_db import (
-    list_chats,
+    get_chats_cached,
+    get_chats_by_id,
     create_chat,
     rename_chat,
     delete_chat,
     add_message,
     get_messages,
+    transaction,
 )
 from rag_backend import answer_text, caption_image
+from uploads import save_image_preview
 
+# Chat area shows the newest messages; older ones are loaded page by page.
+MESSAGES_PAGE_SIZE = 50
 
-def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
+# Inference (Gemini / RAG) runs here instead of on the Dash request thread.
+# Jobs are tracked by id; the browser polls "job-poll" until they finish.
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+PENDING: dict[str, Future] = {}
+# Finished jobs nobody collected (tab closed / reloaded mid-job) are
+# dropped from PENDING this many seconds after they finish.
+JOB_RESULT_TTL = 300.0
+
+# Replies in progress, keyed by (chat_id, text): a double click / double Enter
+# neither stores the user message twice nor asks Gemini twice. on_send_user
+# reserves the key (value: reservation time) before storing the message;
+# on_reply replaces it with the job's Future, whose completion releases it.
+INFLIGHT: dict[tuple, Future | float] = {}
+_INFLIGHT_LOCK = threading.Lock()
+# A reservation whose reply job never started (e.g. the tab was closed
+# between the two callbacks) stops blocking the same message after this.
+RESERVATION_TTL = 60.0
+
+
+def _mark_finished(fut: Future):
+    fut.finished_at = time.monotonic()
+
+
+def _evict_stale_jobs():
+    """Drop finished jobs whose result was never polled within JOB_RESULT_TTL."""
+    now = time.monotonic()
+    for job_id, fut in list(PENDING.items()):
+        finished_at = getattr(fut, "finished_at", None)
+        if finished_at is not None and now - finished_at > JOB_RESULT_TTL:
+            PENDING.pop(job_id, None)
+
+
+def _submit(fn, *args) -> str:
+    _evict_stale_jobs()
+    job_id = uuid4().hex
+    fut = EXECUTOR.submit(fn, *args)
+    fut.add_done_callback(_mark_finished)
+    PENDING[job_id] = fut
+    return job_id
+
+
+def _reserve_reply(chat_id, text) -> bool:
+    """Claim (chat_id, text) for a new reply; False if it is already claimed."""
+    key = (int(chat_id), text)
+    now = time.monotonic()
+    with _INFLIGHT_LOCK:
+        held = INFLIGHT.get(key)
+        if isinstance(held, Future) or (held is not None and now - held < RESERVATION_TTL):
+            return False
+        INFLIGHT[key] = now
+        return True
+
+
+def _release_reply(chat_id, text):
+    with _INFLIGHT_LOCK:
+        INFLIGHT.pop((int(chat_id), text), None)
+
+
+def _submit_reply(chat_id, text):
+    """
+    Start the reply job for a reservation made by _reserve_reply, or return
+    None if the job for it is already running.
+    """
+    key = (int(chat_id), text)
+    with _INFLIGHT_LOCK:
+        if isinstance(INFLIGHT.get(key), Future):
+            return None
+        job_id = _submit(_reply_job, chat_id, text)
+        fut = PENDING[job_id]
+        INFLIGHT[key] = fut
+    fut.add_done_callback(lambda _: _release_reply(chat_id, text))
+    return job_id
+
+
+def _message(msg_id, role, content, meta=None):
+    """Message dict in the shape get_messages() returns (for Patch appends)."""
+    return {"id": msg_id, "role": role, "content": content or "", "meta": meta}
+
+
+def _reply_job(chat_id, text):
+    """Worker: answer via RAG + Gemini and store the assistant message."""
+    reply = answer_text(text)
+    msg_id = add_message(chat_id, "assistant", reply, meta=None)
+    return _message(msg_id, "assistant", reply)
+
+
+def _caption_job(chat_id, b64):
+    """Worker: caption the uploaded image and store it as an assistant message."""
+    result = caption_image(b64)
+    caption = result.get("caption") or "(no caption)"
+    tags = result.get("tags") or []
+    # store the image once as a static file; messages only keep its URL
+    meta = {"image_preview": save_image_preview(b64), "tags": tags}
+    msg_id = add_message(chat_id, "assistant", caption, meta=meta)
+    return _message(msg_id, "assistant", caption, meta)
+
+
+def _messages_page(chat_id, messages_view):
+    """Newest page of a chat: (rendered bubbles, id to load older messages before or None)."""
+    page = get_messages(chat_id, limit=MESSAGES_PAGE_SIZE)
+    oldest = page[0]["id"] if len(page) == MESSAGES_PAGE_SIZE else None
+    return messages_view(page), oldest
+
+
+def _sidebar_meta(chats, active_id):
+    """Compact sidebar state for the "chats-meta" store: [{id, title, active}]."""
+    active = str(active_id)
+    return [
+        {"id": c["id"], "title": c["title"], "active": str(c["id"]) == active}
+        for c in chats
+    ]
+
+
+def register_chat_callbacks(app: dash.Dash, messages_view):
     """
     Register all Dash callbacks for the chat UI.
-    `chat_item` and `messages_view` are helper functions passed from app_dash.py
+    `messages_view` is the helper function passed from app_dash.py
+
+    The sidebar is rendered server-side (chat_item) in the page layout. After
+    that, callbacks that change it only mark a refresh as pending (a token in
+    "refresh-pending") and enable the 100 ms "refresh-tick" interval; when it
+    fires, flush_sidebar reads the chats once and writes [{id, title, active}]
+    to "chats-meta", which assets/sidebar.js renders in the browser. A burst of
+    actions inside the window therefore costs a single sidebar refresh.
     """
 
-    # ---------- Populate sidebar and active chat on load ----------
+    # ---------- Sidebar: render chats-meta in the browser ----------
+    app.clientside_callback(
+        ClientsideFunction(namespace="sidebar", function_name="render"),
+        Output("chat-list", "children", allow_duplicate=True),
+        Input("chats-meta", "data"),
+        prevent_initial_call=True,
+    )
+
+    # ---------- Sidebar: coalesced refresh ----------
     @app.callback(
-        Output("chat-list", "children"),
-        Output("active-chat-id", "data"),
-        Input("tick", "n_intervals"),
-        prevent_initial_call=False,
+        Output("chats-meta", "data"),
+        Output("refresh-tick", "disabled", allow_duplicate=True),
+        Input("refresh-tick", "n_intervals"),
+        State("refresh-pending", "data"),
+        State("active-chat-id", "data"),
+        prevent_initial_call=True,
     )
-    def initial_fill(_):
+    def flush_sidebar(_, pending, active_id):
         try:
-            chats = list_chats()
-            if not chats:
-                active = create_chat("New chat")
-                chats = list_chats()
-            else:
-                active = chats[0]["id"]
-
-            items = [chat_item(c, active) for c in chats]
-            return items, active
+            if not pending:
+                return no_update, True
+            chats = get_chats_cached()
+            return _sidebar_meta(chats, active_id), True
         except Exception as e:
-            print(f"[ERROR] initial_fill: {e}", flush=True)
-            return no_update, no_update
+            print(f"[ERROR] flush_sidebar: {e}", flush=True)
+            return no_update, True
 
     # ---------- New chat ----------
     @app.callback(
-        Output("chat-list", "children", allow_duplicate=True),
+        Output("refresh-pending", "data", allow_duplicate=True),
+        Output("refresh-tick", "disabled", allow_duplicate=True),
         Output("active-chat-id", "data", allow_duplicate=True),
         Input("new-chat", "n_clicks"),
         prevent_initial_call=True,
@@ -54,33 +188,24 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
     def make_new_chat(n):
         try:
             if not n:
-                return no_update, no_update
+                return no_update, no_update, no_update
             cid = create_chat("New chat")
-            chats = list_chats()
-            return [chat_item(c, cid) for c in chats], cid
+            return uuid4().hex, False, cid
         except Exception as e:
             print(f"[ERROR] make_new_chat: {e}", flush=True)
-            return no_update, no_update
+            return no_update, no_update, no_update
 
     # ---------- Select chat from sidebar ----------
     @app.callback(
         Output("active-chat-id", "data", allow_duplicate=True),
-        Input({"type": "chat-select", "chat_id": ALL}, "n_clicks"),
-        State("active-chat-id", "data"),
+        Input("sidebar-click", "data"),
         prevent_initial_call=True,
     )
-    def choose_chat(n_clicks_list, current):
+    def choose_chat(click):
         try:
-            if not n_clicks_list:
+            if not click or click["action"] != "select":
                 return no_update
-            triggered = ctx.triggered_id
-            if isinstance(triggered, dict) and "chat_id" in triggered:
-                chat_id_str = triggered["chat_id"]
-                try:
-                    return int(chat_id_str)
-                except Exception:
-                    return chat_id_str
-            return no_update
+            return click["chat_id"]
         except Exception as e:
             print(f"[ERROR] choose_chat: {e}", flush=True)
             return no_update
@@ -89,102 +214,153 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
     @app.callback(
         Output("chat-title", "children"),
         Output("chat-messages", "children"),
+        Output("oldest-msg-id", "data"),
         Input("active-chat-id", "data"),
-        prevent_initial_call=True,
     )
     def render_chat(active_id):
         try:
             if not active_id:
-                return "New chat", []
-            chats = list_chats()
-            title = next((c["title"] for c in chats if str(c["id"]) == str(active_id)), "Chat")
-            messages = get_messages(active_id)
-            return title, messages_view(messages)
+                return "New chat", [], None
+            title = get_chats_by_id().get(int(active_id), {}).get("title", "Chat")
+            view, oldest = _messages_page(active_id, messages_view)
+            return title, view, oldest
         except Exception as e:
             print(f"[ERROR] render_chat: {e}", flush=True)
+            return no_update, no_update, no_update
+
+    # ---------- Load older messages ----------
+    @app.callback(
+        Output("chat-messages", "children", allow_duplicate=True),
+        Output("oldest-msg-id", "data", allow_duplicate=True),
+        Input("load-older", "n_clicks"),
+        State("oldest-msg-id", "data"),
+        State("active-chat-id", "data"),
+        prevent_initial_call=True,
+    )
+    def load_older(n, oldest, chat_id):
+        try:
+            if not n or not oldest or not chat_id:
+                return no_update, no_update
+            older = get_messages(chat_id, limit=MESSAGES_PAGE_SIZE, before_id=oldest)
+            # prepend without re-sending the bubbles already on screen
+            patch = Patch()
+            for i, bubble in enumerate(messages_view(older)):
+                patch.insert(i, bubble)
+            next_oldest = older[0]["id"] if len(older) == MESSAGES_PAGE_SIZE else None
+            return patch, next_oldest
+        except Exception as e:
+            print(f"[ERROR] load_older: {e}", flush=True)
             return no_update, no_update
 
-    # ---------- Send message (click or Enter) ----------
+    @app.callback(
+        Output("load-older", "style"),
+        Input("oldest-msg-id", "data"),
+    )
+    def toggle_load_older(oldest):
+        return {} if oldest else {"display": "none"}
+
+    # ---------- Send message (click or Enter): echo the user's bubble ----------
     @app.callback(
         Output("chat-messages", "children", allow_duplicate=True),
         Output("chat-title", "children", allow_duplicate=True),
-        Output("chat-list", "children", allow_duplicate=True),
+        Output("refresh-pending", "data", allow_duplicate=True),
+        Output("refresh-tick", "disabled", allow_duplicate=True),
         Output("user-input", "value", allow_duplicate=True),
+        Output("pending-reply", "data"),
         Input("send-btn", "n_clicks"),
         Input("user-input", "n_submit"),
         State("user-input", "value"),
         State("active-chat-id", "data"),
         prevent_initial_call=True,
     )
-    def on_send(clicks, submits, text, chat_id):
+    def on_send_user(clicks, submits, text, chat_id):
         try:
             if not text or not chat_id:
-                return no_update, no_update, no_update, no_update
+                return (no_update,) * 6
+            if not _reserve_reply(chat_id, text):
+                # duplicate submit while the same question is being answered:
+                # just clear the input
+                return no_update, no_update, no_update, no_update, "", no_update
+
+            # current title, read once from the cached snapshot
+            title = get_chats_by_id().get(int(chat_id), {}).get("title", "New chat")
 
-            # add user msg
-            add_message(chat_id, "user", text, meta=None)
-
-            # auto-title if default
-            chats = list_chats()
-            title = next((c["title"] for c in chats if str(c["id"]) == str(chat_id)), "New chat")
-            if title == "New chat":
-                new_title = text.strip()[:40]
-                if new_title:
-                    rename_chat(chat_id, new_title)
-
-            # assistant answer via RAG + Gemini
-            reply = answer_text(text)
-            add_message(chat_id, "assistant", reply, meta=None)
-
-            # refresh
-            chats = list_chats()
-            title = next((c["title"] for c in chats if str(c["id"]) == str(chat_id)), "Chat")
-            messages = get_messages(chat_id)
+            # add user msg + auto-title if default, committed together
+            try:
+                with transaction():
+                    msg_id = add_message(chat_id, "user", text, meta=None)
+                    if title == "New chat":
+                        new_title = text.strip()[:40]
+                        if new_title:
+                            rename_chat(chat_id, new_title)
+                            title = new_title.strip()
+            except Exception:
+                _release_reply(chat_id, text)
+                raise
+
+            # append just the new bubble; sidebar order is refreshed by flush_sidebar,
+            # the answer by on_reply
+            bubbles = Patch()
+            bubbles.extend(messages_view([_message(msg_id, "user", text)]))
             return (
-                messages_view(messages),
+                bubbles,
                 title,
-                [chat_item(c, chat_id) for c in chats],
+                uuid4().hex,
+                False,
                 "",  # clear input
+                {"chat_id": chat_id, "text": text, "msg_id": msg_id},
             )
         except Exception as e:
-            print(f"[ERROR] on_send: {e}", flush=True)
+            print(f"[ERROR] on_send_user: {e}", flush=True)
             # don't crash UI; keep previous content, don't clear input
-            return no_update, no_update, no_update, no_update
+            return (no_update,) * 6
+
+    # ---------- Assistant reply for the message just sent ----------
+    @app.callback(
+        Output("pending-job", "data", allow_duplicate=True),
+        Input("pending-reply", "data"),
+        prevent_initial_call=True,
+    )
+    def on_reply(pending):
+        try:
+            if not pending:
+                return no_update
+
+            # assistant answer via RAG + Gemini, in the background;
+            # takes over the reservation made by on_send_user
+            chat_id = pending["chat_id"]
+            job_id = _submit_reply(chat_id, pending["text"])
+            if job_id is None:
+                # identical reply already running; it is being polled already
+                return no_update
+            jobs = Patch()
+            jobs.append({"job": job_id, "chat_id": chat_id, "kind": "reply"})
+            return jobs
+        except Exception as e:
+            print(f"[ERROR] on_reply: {e}", flush=True)
+            if pending and not isinstance(INFLIGHT.get((int(pending["chat_id"]), pending["text"])), Future):
+                # job never started: drop the reservation so the user can resend
+                _release_reply(pending["chat_id"], pending["text"])
+            return no_update
 
     # ---------- Three-dot menu: rename / delete (open modals) ----------
     @app.callback(
         Output("rename-modal", "is_open", allow_duplicate=True),
         Output("rename-target-id", "data", allow_duplicate=True),
         Output("delete-modal", "is_open", allow_duplicate=True),
-        Input({"type": "chat-action", "key": ALL}, "n_clicks"),
+        Input("sidebar-click", "data"),
         prevent_initial_call=True,
     )
-    def open_action_modals(n_list):
+    def open_action_modals(click):
         try:
-            # ignore initial state where all clicks are zero
-            if not n_list or all((n or 0) == 0 for n in n_list):
+            if not click:
                 return no_update, no_update, no_update
 
-            trig = ctx.triggered_id
-            if isinstance(trig, dict):
-                key = trig.get("key")
-                if not key:
-                    return no_update, no_update, no_update
-                try:
-                    chat_id_str, action = key.split("|", 1)
-                except ValueError:
-                    return no_update, no_update, no_update
-
-                try:
-                    chat_id = int(chat_id_str)
-                except Exception:
-                    chat_id = chat_id_str
-
-                if action == "rename":
-                    return True, chat_id, False
-                elif action == "delete":
-                    return False, chat_id, True
-
+            action = click["action"]
+            if action == "rename":
+                return True, click["chat_id"], False
+            if action == "delete":
+                return False, click["chat_id"], True
             return no_update, no_update, no_update
         except Exception as e:
             print(f"[ERROR] open_action_modals: {e}", flush=True)
@@ -193,7 +369,8 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
     # ---------- Handle rename modal ----------
     @app.callback(
         Output("rename-modal", "is_open", allow_duplicate=True),
-        Output("chat-list", "children", allow_duplicate=True),
+        Output("refresh-pending", "data", allow_duplicate=True),
+        Output("refresh-tick", "disabled", allow_duplicate=True),
         Output("chat-title", "children", allow_duplicate=True),
         Input("rename-save", "n_clicks"),
         Input("rename-cancel", "n_clicks"),
@@ -205,22 +382,22 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
     def handle_rename(save, cancel, chat_id, new_title, active_id):
         try:
             if ctx.triggered_id == "rename-cancel":
-                return False, no_update, no_update
+                return False, no_update, no_update, no_update
             if not save or not chat_id or not new_title:
-                return no_update, no_update, no_update
+                return no_update, no_update, no_update, no_update
 
             rename_chat(chat_id, new_title.strip())
-            chats = list_chats()
-            title = next((c["title"] for c in chats if str(c["id"]) == str(active_id)), "Chat")
-            return False, [chat_item(c, active_id) for c in chats], title
+            title = get_chats_by_id().get(int(active_id), {}).get("title", "Chat")
+            return False, uuid4().hex, False, title
         except Exception as e:
             print(f"[ERROR] handle_rename: {e}", flush=True)
-            return no_update, no_update, no_update
+            return no_update, no_update, no_update, no_update
 
     # ---------- Handle delete modal ----------
     @app.callback(
         Output("delete-modal", "is_open", allow_duplicate=True),
-        Output("chat-list", "children", allow_duplicate=True),
+        Output("refresh-pending", "data", allow_duplicate=True),
+        Output("refresh-tick", "disabled", allow_duplicate=True),
         Output("active-chat-id", "data", allow_duplicate=True),
         Input("delete-confirm", "n_clicks"),
         Input("delete-cancel", "n_clicks"),
@@ -230,17 +407,17 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
     def handle_delete(confirm, cancel, chat_id):
         try:
             if ctx.triggered_id == "delete-cancel":
-                return False, no_update, no_update
+                return False, no_update, no_update, no_update
             if not confirm or not chat_id:
-                return no_update, no_update, no_update
+                return no_update, no_update, no_update, no_update
 
             delete_chat(chat_id)
-            chats = list_chats()
+            chats = get_chats_cached()
             new_active = chats[0]["id"] if chats else create_chat("New chat")
-            return False, [chat_item(c, new_active) for c in chats], new_active
+            return False, uuid4().hex, False, new_active
         except Exception as e:
             print(f"[ERROR] handle_delete: {e}", flush=True)
-            return no_update, no_update, no_update
+            return no_update, no_update, no_update, no_update
 
     # ---------- Image upload & store base64 ----------
     @app.callback(
@@ -257,8 +434,7 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
 
     # ---------- Generate caption ----------
     @app.callback(
-        Output("chat-messages", "children", allow_duplicate=True),
-        Output("chat-list", "children", allow_duplicate=True),
+        Output("pending-job", "data", allow_duplicate=True),
         Input("caption-btn", "n_clicks"),
         State("upload-image-b64", "data"),
         State("active-chat-id", "data"),
@@ -267,17 +443,87 @@ def register_chat_callbacks(app: dash.Dash, chat_item, messages_view):
     def do_caption(n, b64, chat_id):
         try:
             if not n or not b64 or not chat_id:
-                return no_update, no_update
-
-            result = caption_image(b64)
-            caption = result.get("caption") or "(no caption)"
-            tags = result.get("tags") or []
-            meta = {"image_preview": b64, "tags": tags}
+                return no_update
 
-            add_message(chat_id, "assistant", caption, meta=meta)
-            chats = list_chats()
-            messages = get_messages(chat_id)
-            return messages_view(messages), [chat_item(c, chat_id) for c in chats]
+            jobs = Patch()
+            jobs.append({"job": _submit(_caption_job, chat_id, b64), "chat_id": chat_id, "kind": "caption"})
+            return jobs
         except Exception as e:
             print(f"[ERROR] do_caption: {e}", flush=True)
-            return no_update, no_update
+            return no_update
+
+    # ---------- Poller on/off + status line, derived from pending-job ----------
+    app.clientside_callback(
+        ClientsideFunction(namespace="jobs", function_name="pollState"),
+        Output("job-poll", "disabled"),
+        Output("chat-status", "children"),
+        Input("pending-job", "data"),
+    )
+
+    # ---------- Poll background jobs ----------
+    # poll_jobs must not output to "chat-messages": it sits inside
+    # dcc.Loading, which would flash the spinner on every 250 ms poll.
+    # Finished messages go through "finished-messages" instead.
+    @app.callback(
+        Output("finished-messages", "data"),
+        Output("pending-job", "data", allow_duplicate=True),
+        Output("refresh-pending", "data", allow_duplicate=True),
+        Output("refresh-tick", "disabled", allow_duplicate=True),
+        Input("job-poll", "n_intervals"),
+        State("pending-job", "data"),
+        State("active-chat-id", "data"),
+        prevent_initial_call=True,
+    )
+    def poll_jobs(_, jobs, active_id):
+        try:
+            _evict_stale_jobs()
+            jobs = jobs or []
+            if not jobs:
+                return (no_update,) * 4
+
+            done = []
+            for job in jobs:
+                fut = PENDING.get(job["job"])
+                if fut is None or fut.done():
+                    done.append(job)
+            if not done:
+                return (no_update,) * 4
+
+            # Patch removes by value, so jobs added meanwhile are kept
+            remaining = Patch()
+            new_messages = []
+            for job in done:
+                remaining.remove(job)
+                fut = PENDING.pop(job["job"], None)
+                if fut is None:
+                    continue
+                if fut.exception() is not None:
+                    print(f"[ERROR] background job: {fut.exception()}", flush=True)
+                elif str(job["chat_id"]) == str(active_id):
+                    new_messages.append(fut.result())
+
+            finished = no_update
+            if new_messages:
+                # ts: two finishes with equal messages still trigger show_finished
+                finished = {"messages": new_messages, "ts": uuid4().hex}
+            return finished, remaining, uuid4().hex, False
+        except Exception as e:
+            print(f"[ERROR] poll_jobs: {e}", flush=True)
+            return (no_update,) * 4
+
+    # ---------- Append finished answers / captions ----------
+    @app.callback(
+        Output("chat-messages", "children", allow_duplicate=True),
+        Input("finished-messages", "data"),
+        prevent_initial_call=True,
+    )
+    def show_finished(finished):
+        try:
+            if not finished or not finished.get("messages"):
+                return no_update
+            bubbles = Patch()
+            bubbles.extend(messages_view(finished["messages"]))
+            return bubbles
+        except Exception as e:
+            print(f"[ERROR] show_finished: {e}", flush=True)
+            return no_update
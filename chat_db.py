@@ -1,7 +1,24 @@
 import os
 import sqlite3
 import json
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+
+from uploads import is_data_url, save_image_preview
+
+try:
+    # Faster meta (de)serialization; falls back to the stdlib json module
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False)
+
+    _json_loads = json.loads
 
 # You can override this with an env var if you want
 DB_PATH = os.getenv("CHAT_DB_PATH", "assets/db/chat_history.db")
@@ -13,12 +30,103 @@ def _ensure_dir():
         os.makedirs(directory, exist_ok=True)
 
 
+class _ChatsCache:
+    """
+    In-process snapshot of `get_chats()`.
+    Every committed write (create / rename / delete / new message bumping
+    updated_at) marks it dirty, see transaction(); the next read re-queries.
+    Note: the cache is per process, so it only sees writes made by this app.
+    """
+
+    def __init__(self):
+        self._dirty = True
+        self._snapshot = []
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _refresh(self):
+        if self._dirty:
+            # Clear the flag *before* querying so a write that lands
+            # while we read marks the snapshot dirty again.
+            self._dirty = False
+            chats = get_chats()
+            self._snapshot = chats
+            self._by_id = {c["id"]: c for c in chats}
+
+    def get(self):
+        with self._lock:
+            self._refresh()
+            return self._snapshot
+
+    def get_by_id(self):
+        with self._lock:
+            self._refresh()
+            return self._by_id
+
+
+_chats_cache = _ChatsCache()
+
+
+# One long-lived connection for the whole process. Dash's dev server runs
+# each request on a fresh thread, so per-thread connections would be
+# reopened on almost every callback. _LOCK serializes access; it is
+# reentrant so transaction() can nest and helpers can call each other.
+_CON = None
+_LOCK = threading.RLock()
+_depth = 0  # transaction() nesting level, only touched while holding _LOCK
+
+
 def _get_conn():
-    _ensure_dir()
-    # check_same_thread=False so we can use it in Dash callbacks
-    con = sqlite3.connect(DB_PATH, check_same_thread=False)
-    con.row_factory = sqlite3.Row
-    return con
+    global _CON
+    with _LOCK:
+        if _CON is None:
+            _ensure_dir()
+            # check_same_thread=False: shared by all callback threads (guarded by _LOCK).
+            # isolation_level=None: transactions are opened explicitly by transaction().
+            con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+            con.row_factory = sqlite3.Row
+            # WAL lets readers (sidebar refreshes) run while a write is in progress.
+            # The mode is persistent; NORMAL only needs fsync at checkpoints in WAL.
+            con.execute("PRAGMA journal_mode=WAL;")
+            con.execute("PRAGMA synchronous=NORMAL;")
+            con.execute("PRAGMA foreign_keys=ON;")
+            _CON = con
+        return _CON
+
+
+@contextmanager
+def transaction():
+    """
+    Run several writes as one SQLite transaction (one commit / fsync):
+
+        with transaction():
+            add_message(...)
+            rename_chat(...)
+
+    Nested use joins the outermost transaction. The chats snapshot is
+    invalidated once the outermost transaction commits.
+    """
+    global _depth
+    with _LOCK:
+        con = _get_conn()
+        outermost = _depth == 0
+        if outermost:
+            con.execute("BEGIN IMMEDIATE")
+        _depth += 1
+        try:
+            yield con
+        except BaseException:
+            _depth -= 1
+            if outermost:
+                con.execute("ROLLBACK")
+            raise
+        _depth -= 1
+        if outermost:
+            con.execute("COMMIT")
+            _chats_cache.invalidate()
 
 
 def _ensure_schema():
@@ -27,61 +135,95 @@ def _ensure_schema():
     a `content` column on messages, so new code doesn't crash with
     'no such column: content'.
     """
-    con = _get_conn()
-    cur = con.cursor()
-
-    # --- chats table ---
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
-        );
-        """
-    )
-
-    # --- messages table (new schema) ---
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT,         -- main text of the message
-            meta TEXT,            -- JSON (e.g. for image captions, etc.)
-            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE
-        );
-        """
-    )
-
-    # --- migrate older schemas if needed ---
-    cur.execute("PRAGMA table_info(messages);")
-    cols_info = cur.fetchall()
-    col_names = [row["name"] for row in cols_info]
-
-    # If table existed without `content` column, add it.
-    if "content" not in col_names:
-        cur.execute("ALTER TABLE messages ADD COLUMN content TEXT;")
-
-    # If there was an older `text` column, copy it into `content`
-    if "text" in col_names:
-        cur.execute("UPDATE messages SET content = text WHERE content IS NULL;")
-
-    # Ensure meta exists (older schema might miss it)
-    if "meta" not in col_names:
-        cur.execute("ALTER TABLE messages ADD COLUMN meta TEXT;")
-
-    con.commit()
-    con.close()
+    with transaction() as con:
+        cur = con.cursor()
+
+        # --- chats table ---
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+
+        # --- messages table (new schema) ---
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT,         -- main text of the message
+                meta TEXT,            -- JSON (e.g. for image captions, etc.)
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE
+            );
+            """
+        )
+
+        # --- migrate older schemas if needed ---
+        cur.execute("PRAGMA table_info(messages);")
+        cols_info = cur.fetchall()
+        col_names = [row["name"] for row in cols_info]
+
+        # If table existed without `content` column, add it.
+        if "content" not in col_names:
+            cur.execute("ALTER TABLE messages ADD COLUMN content TEXT;")
+
+        # If there was an older `text` column, copy it into `content`
+        if "text" in col_names:
+            cur.execute("UPDATE messages SET content = text WHERE content IS NULL;")
+
+        # Ensure meta exists (older schema might miss it)
+        if "meta" not in col_names:
+            cur.execute("ALTER TABLE messages ADD COLUMN meta TEXT;")
+
+        # Timestamps are ISO-8601 text, so they sort lexically. Rows that got
+        # the CURRENT_TIMESTAMP default ("YYYY-MM-DD HH:MM:SS") are rewritten
+        # to the same "T" separator as the ones written by this module.
+        cur.execute(
+            "UPDATE chats SET updated_at = replace(updated_at, ' ', 'T') "
+            "WHERE updated_at LIKE '% %';"
+        )
+
+        # --- indexes ---
+        # get_messages: WHERE chat_id=? ORDER BY id
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_chat_id ON messages(chat_id, id);")
+        # get_chats / get_or_create_default_chat: ORDER BY updated_at DESC, id DESC
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_chats_updated ON chats(updated_at DESC, id DESC);")
 
 
 # Run schema check/migration on import
 _ensure_schema()
 
 
+# ---------------------------------------------------------------------
+# Hot statements, kept as constants so every call passes the exact same
+# text and hits sqlite3's prepared-statement cache.
+# ---------------------------------------------------------------------
+
+# Timestamps are produced by SQLite itself: UTC ISO-8601 with milliseconds,
+# same "T" separator as older rows, so text order is still time order.
+_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+
+_SQL_SELECT_CHATS = "SELECT id, title, updated_at FROM chats ORDER BY updated_at DESC, id DESC"
+_SQL_LATEST_CHAT_ID = "SELECT id FROM chats ORDER BY updated_at DESC, id DESC LIMIT 1"
+_SQL_INSERT_CHAT = f"INSERT INTO chats (title, created_at, updated_at) VALUES (?, {_NOW}, {_NOW})"
+_SQL_RENAME_CHAT = f"UPDATE chats SET title=?, updated_at={_NOW} WHERE id=?"
+_SQL_TOUCH_CHAT = f"UPDATE chats SET updated_at={_NOW} WHERE id=?"
+_SQL_DELETE_CHAT_MSGS = "DELETE FROM messages WHERE chat_id=?"
+_SQL_DELETE_CHAT = "DELETE FROM chats WHERE id=?"
+_SQL_ADD_MSG = (
+    "INSERT INTO messages (chat_id, role, content, meta, created_at) "
+    f"VALUES (?, ?, ?, ?, {_NOW})"
+)
+_SQL_UPDATE_MSG_META = "UPDATE messages SET meta=? WHERE id=?"
+
+
 # ---------------------------------------------------------------------
 # API functions expected by app_dash.py
 # ---------------------------------------------------------------------
@@ -102,21 +244,12 @@ def get_chats():
       ...
     ]
     """
-    con = _get_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        SELECT id, title, updated_at
-        FROM chats
-        ORDER BY datetime(updated_at) DESC, id DESC
-        """
-    )
-    rows = cur.fetchall()
-    con.close()
+    with _LOCK:
+        rows = _get_conn().execute(_SQL_SELECT_CHATS).fetchall()
 
     return [
         {
-            "id": row["id"],
+            "id": int(row["id"]),
             "title": row["title"],
             "updated_at": row["updated_at"],
         }
@@ -132,28 +265,38 @@ def list_chats():
     return get_chats()
 
 
+def get_chats_cached():
+    """
+    Same shape as `list_chats()`, but served from the in-process snapshot.
+    Treat the returned list as read-only.
+    """
+    return _chats_cache.get()
+
+
+def get_chats_by_id():
+    """
+    {chat_id (int): chat dict} built from the same snapshot as
+    `get_chats_cached()`. Treat as read-only.
+    """
+    return _chats_cache.get_by_id()
+
+
 def get_or_create_default_chat():
     """
     If no chats exist yet, create one 'New chat' and return its id.
     Otherwise return the most recently updated chat.
     """
-    con = _get_conn()
-    cur = con.cursor()
-    cur.execute("SELECT id FROM chats ORDER BY datetime(updated_at) DESC, id DESC LIMIT 1")
-    row = cur.fetchone()
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(_SQL_LATEST_CHAT_ID)
+        row = cur.fetchone()
 
-    if row:
-        chat_id = row["id"]
-    else:
-        now = datetime.utcnow().isoformat()
-        cur.execute(
-            "INSERT INTO chats (title, created_at, updated_at) VALUES (?, ?, ?)",
-            ("New chat", now, now),
-        )
-        chat_id = cur.lastrowid
-        con.commit()
+        if row:
+            chat_id = row["id"]
+        else:
+            cur.execute(_SQL_INSERT_CHAT, ("New chat",))
+            chat_id = cur.lastrowid
 
-    con.close()
     return chat_id
 
 
@@ -164,17 +307,10 @@ def create_chat(title: str | None = None) -> int:
     if not title or not title.strip():
         title = "New chat"
 
-    now = datetime.utcnow().isoformat()
-
-    con = _get_conn()
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO chats (title, created_at, updated_at) VALUES (?, ?, ?)",
-        (title, now, now),
-    )
-    chat_id = cur.lastrowid
-    con.commit()
-    con.close()
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(_SQL_INSERT_CHAT, (title,))
+        chat_id = cur.lastrowid
     return chat_id
 
 
@@ -185,28 +321,19 @@ def rename_chat(chat_id: int, new_title: str):
     if not new_title or not new_title.strip():
         return
 
-    now = datetime.utcnow().isoformat()
-    con = _get_conn()
-    cur = con.cursor()
-    cur.execute(
-        "UPDATE chats SET title=?, updated_at=? WHERE id=?",
-        (new_title.strip(), now, chat_id),
-    )
-    con.commit()
-    con.close()
+    with transaction() as con:
+        con.execute(_SQL_RENAME_CHAT, (new_title.strip(), chat_id))
 
 
 def delete_chat(chat_id: int):
     """
     Delete a chat and all its messages.
     """
-    con = _get_conn()
-    cur = con.cursor()
-    # Delete messages first for safety (FOREIGN KEY with CASCADE should also handle it)
-    cur.execute("DELETE FROM messages WHERE chat_id=?", (chat_id,))
-    cur.execute("DELETE FROM chats WHERE id=?", (chat_id,))
-    con.commit()
-    con.close()
+    with transaction() as con:
+        cur = con.cursor()
+        # Delete messages first for safety (FOREIGN KEY with CASCADE should also handle it)
+        cur.execute(_SQL_DELETE_CHAT_MSGS, (chat_id,))
+        cur.execute(_SQL_DELETE_CHAT, (chat_id,))
 
 
 # ---------------------------------------------------------------------
@@ -223,34 +350,56 @@ def add_message(chat_id: int, role: str, content: str, meta: dict | None = None)
     if meta is None:
         meta_json = None
     else:
-        meta_json = json.dumps(meta, ensure_ascii=False)
-
-    now = datetime.utcnow().isoformat()
-
-    con = _get_conn()
-    cur = con.cursor()
-    cur.execute(
-        """
-        INSERT INTO messages (chat_id, role, content, meta, created_at)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (chat_id, role, content, meta_json, now),
-    )
-
-    msg_id = cur.lastrowid
-
-    # bump chat updated_at
-    cur.execute(
-        "UPDATE chats SET updated_at=? WHERE id=?",
-        (now, chat_id),
-    )
-
-    con.commit()
-    con.close()
+        meta_json = _json_dumps(meta)
+
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(_SQL_ADD_MSG, (chat_id, role, content, meta_json))
+
+        msg_id = cur.lastrowid
+
+        # bump chat updated_at
+        cur.execute(_SQL_TOUCH_CHAT, (chat_id,))
+
     return msg_id
 
 
-def get_messages(chat_id: int):
+def add_messages_bulk(chat_id: int, items):
+    """
+    Insert many messages into one chat in a single transaction
+    (e.g. when importing a session).
+    items: iterable of (role, content) or (role, content, meta) tuples.
+    """
+    rows = []
+    for item in items:
+        role, content = item[0], item[1]
+        meta = item[2] if len(item) > 2 else None
+        meta_json = None if meta is None else _json_dumps(meta)
+        rows.append((chat_id, role, content, meta_json))
+
+    if not rows:
+        return
+
+    with transaction() as con:
+        con.executemany(_SQL_ADD_MSG, rows)
+        con.execute(_SQL_TOUCH_CHAT, (chat_id,))
+
+
+def _migrate_image_preview(msg_id: int, meta: dict) -> dict:
+    """
+    Older messages kept the whole base64 image in meta["image_preview"].
+    Move it to a file under assets/uploads and store the URL instead.
+    """
+    url = save_image_preview(meta["image_preview"])
+    if url is None:
+        return meta
+    meta = {**meta, "image_preview": url}
+    with transaction() as con:
+        con.execute(_SQL_UPDATE_MSG_META, (_json_dumps(meta), msg_id))
+    return meta
+
+
+def get_messages(chat_id: int, limit: int | None = None, before_id: int | None = None):
     """
     Return messages for a chat in ascending order:
     [
@@ -258,31 +407,54 @@ def get_messages(chat_id: int):
       ...
     ]
     This matches what app_dash.py expects for rendering ChatGPT-style bubbles.
+
+    limit: only the newest `limit` messages (still returned oldest first).
+    before_id: only messages with id < before_id (for loading older pages).
     """
-    con = _get_conn()
-    cur = con.cursor()
+    where = "WHERE chat_id=?"
+    params = [chat_id]
+    if before_id is not None:
+        where += " AND id<?"
+        params.append(before_id)
 
     # IMPORTANT: now this SELECT is safe because we always ensure `content` column exists
-    cur.execute(
-        """
-        SELECT id, role, content, meta, created_at
-        FROM messages
-        WHERE chat_id=?
-        ORDER BY id ASC
-        """,
-        (chat_id,),
-    )
-    rows = cur.fetchall()
-    con.close()
+    with _LOCK:
+        cur = _get_conn().cursor()
+        if limit is None:
+            cur.execute(
+                f"""
+                SELECT id, role, content, meta, created_at
+                FROM messages
+                {where}
+                ORDER BY id ASC
+                """,
+                params,
+            )
+            rows = cur.fetchall()
+        else:
+            cur.execute(
+                f"""
+                SELECT id, role, content, meta, created_at
+                FROM messages
+                {where}
+                ORDER BY id DESC
+                LIMIT ?
+                """,
+                params + [limit],
+            )
+            rows = cur.fetchall()[::-1]
 
     messages = []
     for row in rows:
         meta_raw = row["meta"]
         try:
-            meta_obj = json.loads(meta_raw) if meta_raw else None
+            meta_obj = _json_loads(meta_raw) if meta_raw else None
         except Exception:
             meta_obj = None
 
+        if meta_obj and is_data_url(meta_obj.get("image_preview")):
+            meta_obj = _migrate_image_preview(row["id"], meta_obj)
+
         messages.append(
             {
                 "id": row["id"],
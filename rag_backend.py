@@ -1,25 +1,66 @@
 import os
 import io
-import json
-import base64
+import re
 import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 import numpy as np
+import torch
 from PIL import Image
 from sentence_transformers import SentenceTransformer
 import google.generativeai as genai
 
+try:
+    # Optional: ONNX Runtime query encoder (pip install onnxruntime)
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+from uploads import decode_data_url
+from rag_index import (
+    faiss, read_docs, empty_docs, build_faiss_index, faiss_index_kind, export_paths, db_fingerprint,
+)
+
+try:
+    # Faster JSON parsing (legacy embeddings, index metadata, caption replies)
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 # Paths for RAG index (must match scripts/build_index.py)
 DB_PATH = os.getenv("RAG_DB_PATH", "assets/db/rag.db")
+# Normalized embedding matrix + row metadata exported by build_index next to
+# DB_PATH (preferred while they still match the DB), and the FAISS index over
+# the exported matrix, opened memory-mapped
+_EXPORT_PATHS = export_paths(DB_PATH)
+MATRIX_PATH = os.getenv("RAG_MATRIX_PATH", _EXPORT_PATHS[0])
+META_PATH = os.getenv("RAG_META_PATH", _EXPORT_PATHS[1])
+FAISS_PATH = os.getenv("RAG_FAISS_PATH", _EXPORT_PATHS[2])
 EMBED_MODEL_PATH = os.getenv("RAG_EMBED_MODEL", "assets/models/all-MiniLM-L6-v2")
+# Fixed upper bound on tokens per query (MiniLM was trained with 256)
+EMBED_MAX_SEQ_LEN = int(os.getenv("RAG_EMBED_MAX_SEQ_LEN", "256"))
+# Set RAG_EMBED_COMPILE=1 to torch.compile the encoder (slow first call, faster after)
+EMBED_COMPILE = os.getenv("RAG_EMBED_COMPILE", "0") == "1"
+# ONNX export of the same model (see README); used instead of PyTorch when
+# onnxruntime is installed and the file exists. Set to "" to disable.
+EMBED_ONNX_PATH = os.getenv("RAG_EMBED_ONNX", "assets/models/all-MiniLM-L6-v2-onnx/model.onnx")
 
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# FAISS index type: RAG_FAISS_SQ / RAG_FAISS_HNSW_MIN, see rag_index.py
+
+# Outermost {...} in a model reply (some models wrap JSON in ```json blocks)
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
 
 _configured = False
 _embed_model = None
+_MODEL_LOCK = threading.Lock()
+_RAG_LOCK = threading.Lock()
 _rag_texts = []
 _rag_meta = []
-_rag_embeddings = None  # numpy array [N, D]
+_rag_embeddings = None  # numpy array [N, D], rows L2-normalized
+_rag_index = None       # faiss index over L2-normalized _rag_embeddings (if faiss is installed)
 
 
 def _configure():
@@ -36,69 +77,188 @@ def _ensure_config():
         _configured = True
 
 
+class _OnnxEncoder:
+    """
+    MiniLM on ONNX Runtime (CPU): tokenize -> run -> mean-pool -> normalize,
+    i.e. the same pipeline as the SentenceTransformer, without PyTorch eager mode.
+    """
+
+    def __init__(self, onnx_path, tokenizer_path):
+        from transformers import AutoTokenizer
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+    def encode(self, texts):
+        enc = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=EMBED_MAX_SEQ_LEN,
+            return_tensors="np",
+        )
+        feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self.input_names}
+        hidden = self.session.run(None, feeds)[0]  # last_hidden_state [B, T, H]
+
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        emb = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-8)
+        return emb.astype(np.float32, copy=False)
+
+
 def _load_embed_model():
     global _embed_model
-    if _embed_model is None:
-        _embed_model = SentenceTransformer(EMBED_MODEL_PATH)
+    if _embed_model is not None:
+        return _embed_model
+
+    # Concurrent first callbacks would otherwise each load their own copy
+    with _MODEL_LOCK:
+        if _embed_model is None and ort is not None and EMBED_ONNX_PATH and os.path.exists(EMBED_ONNX_PATH):
+            try:
+                _embed_model = _OnnxEncoder(EMBED_ONNX_PATH, EMBED_MODEL_PATH)
+            except Exception as e:
+                print(f"[ERROR] onnx encoder: {e}", flush=True)
+        if _embed_model is None:
+            model = SentenceTransformer(EMBED_MODEL_PATH)
+            model.max_seq_length = EMBED_MAX_SEQ_LEN
+            model.eval()
+            if EMBED_COMPILE and hasattr(torch, "compile"):
+                # Compile the transformer module only, so model.encode() keeps working.
+                # dynamic=True: queries have different lengths, avoid a recompile per length.
+                transformer = model[0]
+                transformer.auto_model = torch.compile(transformer.auto_model, dynamic=True)
+            _embed_model = model
     return _embed_model
 
 
-def _load_rag_index():
+def _encode(texts):
+    """Embed a list of texts -> float32 array [len(texts), D]."""
+    model = _load_embed_model()
+    if isinstance(model, _OnnxEncoder):
+        return model.encode(texts)
+    with torch.inference_mode():
+        return model.encode(texts, convert_to_numpy=True).astype("float32", copy=False)
+
+
+def _load_rag_matrix():
     """
-    Load all embeddings + texts from the SQLite DB into memory (once).
-    Expects a table like:
-      docs(id INTEGER, source TEXT, page INTEGER, text TEXT, embedding TEXT_JSON)
+    (texts, meta, embeddings, header) from the exported .npy + .jsonl pair,
+    with the matrix memory-mapped read-only. The first .jsonl line is a header
+    written by build_index. None if the files are missing, don't line up, or
+    were exported from a different state of the DB at DB_PATH.
     """
-    global _rag_texts, _rag_meta, _rag_embeddings
+    if not (os.path.exists(DB_PATH) and os.path.exists(MATRIX_PATH) and os.path.exists(META_PATH)):
+        return None
+    try:
+        with open(META_PATH, encoding="utf-8") as f:
+            header = _json_loads(f.readline() or "{}")
+            if "format" not in header:
+                return None  # exported by an older build_index
+            if header.get("db") != _rag_db_fingerprint():
+                return None  # DB changed (or is another DB) since the export
+            emb = np.load(MATRIX_PATH, mmap_mode="r")
+            texts = []
+            meta = []
+            for line in f:
+                row = _json_loads(line)
+                texts.append(row["text"])
+                meta.append({"id": row["id"], "source": row["source"], "page": row["page"]})
+    except Exception as e:
+        print(f"[ERROR] rag matrix: {e}", flush=True)
+        return None
+    if emb.ndim != 2 or emb.dtype != np.float32 or emb.shape[0] != len(texts):
+        return None
+    return texts, meta, emb, header
+
+
+def _rag_db_fingerprint():
+    """rag_index.db_fingerprint of the DB at DB_PATH, or None if it can't be read."""
+    try:
+        con = sqlite3.connect(DB_PATH)
+        try:
+            return db_fingerprint(con)
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return None
 
-    if _rag_embeddings is not None:
-        return
 
+def _read_rag_db():
+    """(texts, meta, embeddings) read from the SQLite DB, see rag_index.read_docs."""
     if not os.path.exists(DB_PATH):
         # No index yet – RAG will be skipped
-        _rag_texts = []
-        _rag_meta = []
-        _rag_embeddings = np.zeros((0, 1), dtype="float32")
-        return
+        return empty_docs()
 
     con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-
+    # Let SQLite read the file through a memory map instead of read() calls
+    con.execute("PRAGMA mmap_size=268435456;")  # 256 MB
     try:
-        cur.execute("SELECT id, source, page, text, embedding FROM docs")
+        return read_docs(con)
     except sqlite3.Error:
         # Fallback if schema is different / db broken
-        _rag_texts = []
-        _rag_meta = []
-        _rag_embeddings = np.zeros((0, 1), dtype="float32")
+        return empty_docs()
+    finally:
         con.close()
+
+
+def _load_rag_index():
+    """
+    Load all embeddings + texts into memory (once, thread-safe).
+    Prefers the memory-mapped matrix exported by build_index (already
+    normalized); otherwise reads the SQLite DB.
+    """
+    global _rag_texts, _rag_meta, _rag_embeddings, _rag_index
+
+    if _rag_embeddings is not None:
         return
 
-    rows = cur.fetchall()
-    con.close()
+    with _RAG_LOCK:
+        if _rag_embeddings is not None:
+            return
+        exported = _load_rag_matrix()
+        if exported:
+            texts, meta, emb, header = exported
+        else:
+            (texts, meta, emb), header = _read_rag_db(), {}
+        index = None
+        if faiss is not None and emb.shape[0]:
+            # The persisted index is memory-mapped; building one here copies
+            # every vector into FAISS's own (resident) storage instead.
+            index = _read_faiss_index(emb, header) or build_faiss_index(emb)
+        _rag_texts, _rag_meta, _rag_index = texts, meta, index
+        # Published last: a non-None _rag_embeddings means "fully loaded"
+        _rag_embeddings = emb
+
+
+def _read_faiss_index(emb, header):
+    """
+    FAISS index saved by build_index for the exported matrix, or None if
+    there is none or it is not the type the current settings ask for.
+    """
+    if header.get("faiss") != faiss_index_kind(emb.shape[0]) or not os.path.exists(FAISS_PATH):
+        return None
+    # Zero-copy mmap of the vector codes where this faiss build supports it
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    try:
+        index = faiss.read_index(FAISS_PATH, flags)
+    except Exception as e:
+        print(f"[ERROR] faiss index: {e}", flush=True)
+        return None
+    if index.ntotal != emb.shape[0] or index.d != emb.shape[1]:
+        return None
+    return index
 
-    texts = []
-    meta = []
-    embeds = []
 
-    for row in rows:
-        _id, source, page, text, emb_json = row
-        try:
-            emb = np.array(json.loads(emb_json), dtype="float32")
-        except Exception:
-            continue
-        texts.append(text)
-        meta.append({"id": _id, "source": source, "page": page})
-        embeds.append(emb)
-
-    if embeds:
-        _rag_texts = texts
-        _rag_meta = meta
-        _rag_embeddings = np.vstack(embeds)
-    else:
-        _rag_texts = []
-        _rag_meta = []
-        _rag_embeddings = np.zeros((0, 1), dtype="float32")
+@lru_cache(maxsize=2048)
+def _embed(text: str):
+    """Cached unit-length query embedding (read-only; repeated prompts skip the model)."""
+    vec = _encode([text])[0]
+    vec /= max(float(np.linalg.norm(vec)), 1e-8)
+    vec.setflags(write=False)
+    return vec
 
 
 def _semantic_search(query: str, top_k: int = 5):
@@ -108,23 +268,36 @@ def _semantic_search(query: str, top_k: int = 5):
     """
     _load_rag_index()
     if _rag_embeddings is None or _rag_embeddings.shape[0] == 0:
+        # Nothing to search: don't load the embedding model or encode the query
         return []
+    return list(_semantic_search_cached(query, top_k))
 
-    model = _load_embed_model()
-    q_vec = model.encode([query])[0].astype("float32")
 
-    # cosine similarity
-    emb = _rag_embeddings
-    q_norm = np.linalg.norm(q_vec) + 1e-8
-    e_norm = np.linalg.norm(emb, axis=1) + 1e-8
-    sims = (emb @ q_vec) / (e_norm * q_norm)
+@lru_cache(maxsize=1024)
+def _semantic_search_cached(query: str, top_k: int):
+    """Retrieval results per (query, top_k), as a tuple so they can be cached."""
+    q_vec = _embed(query)
 
-    idx = np.argsort(-sims)[:top_k]
-    results = []
-    for i in idx:
-        i = int(i)
-        results.append((_rag_texts[i], _rag_meta[i], float(sims[i])))
-    return results
+    if _rag_index is not None:
+        q = q_vec.reshape(1, -1).copy()
+        scores, ids = _rag_index.search(q, top_k)
+        return tuple(
+            (_rag_texts[i], _rag_meta[i], float(score))
+            for i, score in zip(ids[0].tolist(), scores[0].tolist())
+            if i >= 0
+        )
+
+    # cosine similarity (numpy fallback); rows and query are unit length
+    sims = _rag_embeddings @ q_vec
+
+    # O(N) partial selection of the top_k, then sort just those
+    k = min(top_k, sims.shape[0])
+    part = np.argpartition(-sims, k - 1)[:k]
+    idx = part[np.argsort(-sims[part])]
+    return tuple(
+        (_rag_texts[i], _rag_meta[i], float(sims[i]))
+        for i in idx.tolist()
+    )
 
 
 def caption_image(b64_data: str):
@@ -136,24 +309,23 @@ def caption_image(b64_data: str):
     if not b64_data:
         return {"caption": "", "tags": [], "raw_text": ""}
 
-    # Strip "data:image/xxx;base64," prefix if present
-    if "," in b64_data:
-        _, b64_str = b64_data.split(",", 1)
-    else:
-        b64_str = b64_data
+    # Big images are downscaled to save tokens
+    max_side = 1024
 
     try:
-        img_bytes = base64.b64decode(b64_str)
-        image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+        # strips the "data:image/xxx;base64," prefix if present
+        img_bytes = decode_data_url(b64_data)
+        image = Image.open(io.BytesIO(img_bytes))
+        # JPEGs: let libjpeg decode at 1/2, 1/4 or 1/8 scale (still >= max_side)
+        # instead of decoding every pixel and throwing most of them away.
+        image.draft("RGB", (max_side, max_side))
+        image.load()
+        image = image.convert("RGB")
     except Exception:
         return {"caption": "", "tags": [], "raw_text": ""}
 
-    # Optionally resize big images to save tokens
-    max_side = 1024
-    w, h = image.size
-    if max(w, h) > max_side:
-        scale = max_side / float(max(w, h))
-        image = image.resize((int(w * scale), int(h * scale)))
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
 
     model = genai.GenerativeModel(GEMINI_MODEL)
     prompt = (
@@ -172,14 +344,11 @@ def caption_image(b64_data: str):
 
     # Robust JSON parse
     try:
-        # Some models wrap JSON in ```json blocks
-        import re
-
-        m = re.search(r"\{.*\}", raw_text, flags=re.DOTALL)
+        m = _JSON_RE.search(raw_text)
         if m:
-            data = json.loads(m.group(0))
+            data = _json_loads(m.group(0))
         else:
-            data = json.loads(raw_text)
+            data = _json_loads(raw_text)
 
         if isinstance(data, dict):
             caption = data.get("caption", "")
@@ -197,11 +366,79 @@ def caption_image(b64_data: str):
     return {"caption": caption, "tags": tags, "raw_text": raw_text}
 
 
+def _normalize_prompt(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class _AnswerCache:
+    """
+    LRU of answers keyed by the normalized prompt. Only the key is
+    normalized: the answer itself is generated from the user's original text.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            answer = self._data.get(key)
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return answer
+
+    def put(self, key, answer):
+        with self._lock:
+            self._data[key] = answer
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def info(self) -> dict:
+        # Same shape as lru_cache's cache_info()._asdict()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "maxsize": self.maxsize,
+                "currsize": len(self._data),
+            }
+
+
+_answer_cache = _AnswerCache(maxsize=512)
+
+
 def answer_text(prompt: str) -> str:
     """
     Retrieval-augmented answer using local SQLite embeddings + Gemini 2.5 Flash.
     If the RAG index is missing, falls back to plain Gemini answer.
+    Answers are cached per normalized prompt (case / whitespace insensitive),
+    but Gemini always sees the prompt as the user typed it.
     """
+    key = _normalize_prompt(prompt)
+    answer = _answer_cache.get(key)
+    if answer is None:
+        answer = _answer_text_impl(prompt)
+        _answer_cache.put(key, answer)
+    return answer
+
+
+def cache_stats() -> dict:
+    """Hit/miss counters of the answer, retrieval and embedding caches (for tuning)."""
+    return {
+        "answer_text": _answer_cache.info(),
+        "semantic_search": _semantic_search_cached.cache_info()._asdict(),
+        "embed": _embed.cache_info()._asdict(),
+    }
+
+
+def _answer_text_impl(prompt: str) -> str:
     _ensure_config()
     model = genai.GenerativeModel(GEMINI_MODEL)
 
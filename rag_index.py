@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+try:
+    # Optional: exact inner-product search on BLAS kernels (pip install faiss-cpu)
+    import faiss
+except ImportError:
+    faiss = None
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+# Shared by the app (rag_backend.py) and the indexer (scripts/build_index.py),
+# so a FAISS index persisted at build time is the one the app would build.
+
+# Above this many chunks the FAISS index switches from exact to HNSW search
+FAISS_HNSW_MIN = int(os.getenv("RAG_FAISS_HNSW_MIN", "100000"))
+# Scalar quantization of the exact FAISS index: "fp16" (default), "8bit" or "none".
+# Halves / quarters the bytes scanned per query at a negligible recall cost.
+FAISS_SQ = os.getenv("RAG_FAISS_SQ", "fp16")
+
+
+def parse_embedding(raw):
+    """float32 vector from a BLOB (current format) or JSON text (older indexes)."""
+    if isinstance(raw, bytes):
+        return np.frombuffer(raw, dtype=np.float32)
+    return np.asarray(_json_loads(raw), dtype=np.float32)
+
+
+def export_paths(db_path):
+    """(matrix, meta, faiss) paths build_index exports next to the DB at db_path."""
+    base = os.path.splitext(db_path)[0]
+    return base + ".f32.npy", base + ".meta.jsonl", base + ".faiss"
+
+
+def db_fingerprint(con):
+    """
+    {"count", "max_id"} of the docs table. Recorded in the export header and
+    compared at startup: ids are AUTOINCREMENT, so any insert changes max_id
+    and any delete changes count. (File mtimes don't work here: WAL
+    checkpointing on close touches the DB after the export.)
+    """
+    count, max_id = con.execute("SELECT COUNT(*), MAX(id) FROM docs").fetchone()
+    return {"count": count, "max_id": max_id}
+
+
+def empty_docs():
+    return [], [], np.zeros((0, 1), dtype="float32")
+
+
+def read_docs(con):
+    """
+    (texts, meta, embeddings) for every chunk in the docs table, ordered by id,
+    embeddings as an L2-normalized float32 [N, D] matrix. Expects a table like:
+      docs(id INTEGER, source TEXT, page INTEGER, text TEXT, embedding BLOB, dim INTEGER)
+    Indexes built before the BLOB format (embedding as JSON text) still load.
+    Raises sqlite3.Error if the table is missing / broken.
+    """
+    cur = con.cursor()
+    cur.arraysize = 4096  # rows per fetchmany()
+    (n_rows,) = cur.execute("SELECT COUNT(*) FROM docs").fetchone()
+    cur.execute("SELECT id, source, page, text, embedding FROM docs ORDER BY id")
+
+    texts = []
+    meta = []
+    out = None  # preallocated [n_rows, D] once D is known
+    n = 0
+
+    # Stream in batches rather than fetchall(): no full list of row tuples
+    while rows := cur.fetchmany():
+        for _id, source, page, text, raw in rows:
+            try:
+                emb = parse_embedding(raw)
+            except Exception:
+                continue
+            if out is None:
+                out = np.empty((n_rows, emb.shape[0]), dtype=np.float32)
+            elif emb.shape[0] != out.shape[1]:
+                continue
+            out[n] = emb
+            n += 1
+            texts.append(text)
+            meta.append({"id": _id, "source": source, "page": page})
+
+    if not n:
+        return empty_docs()
+
+    # Unit-length rows: cosine similarity becomes a plain inner product
+    emb = out[:n]
+    emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-8)
+    return texts, meta, emb
+
+
+def faiss_index_kind(n_rows: int) -> str:
+    """Name of the index type build_faiss_index picks for n_rows under the current settings."""
+    if n_rows > FAISS_HNSW_MIN:
+        return "hnsw32"
+    if FAISS_SQ in ("fp16", "8bit"):
+        return f"sq-{FAISS_SQ}"
+    return "flat"
+
+
+def build_faiss_index(emb):
+    """Inner-product index over the L2-normalized rows (inner product == cosine)."""
+    dim = emb.shape[1]
+    kind = faiss_index_kind(emb.shape[0])
+
+    if kind == "hnsw32":
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    elif kind == "sq-fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif kind == "sq-8bit":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(emb)  # per-dimension value ranges
+    else:
+        index = faiss.IndexFlatIP(dim)
+    index.add(emb)
+    return index
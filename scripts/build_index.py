@@ -1,14 +1,30 @@
 # scripts/build_index.py
 import os
-import sqlite3
+import sys
 import json
+import sqlite3
+from bisect import bisect_left, bisect_right
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import fitz  # PyMuPDF
+import torch
 from sentence_transformers import SentenceTransformer
 
+# Shared with the app: docs reader + FAISS index factory (project root module)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from rag_index import (  # noqa: E402
+    faiss, read_docs, build_faiss_index, faiss_index_kind, export_paths, db_fingerprint,
+)
+
 # Paths (relative to project root)
-DB_PATH = "assets/db/rag.db"
+DB_PATH = os.getenv("RAG_DB_PATH", "assets/db/rag.db")
+# Exported next to DB_PATH (rag.db -> rag.f32.npy, rag.meta.jsonl, rag.faiss):
+#   MATRIX_PATH  normalized [N, D] float32, mmap'd by the app
+#   META_PATH    header line, then one {"id","source","page","text"} per matrix row
+#   FAISS_PATH   FAISS index over the same rows (if faiss is installed)
+MATRIX_PATH, META_PATH, FAISS_PATH = export_paths(DB_PATH)
 DATA_DIR = "assets/data/pdfs"
 EMBED_MODEL_PATH = "assets/models/all-MiniLM-L6-v2"
 
@@ -16,68 +32,276 @@ EMBED_MODEL_PATH = "assets/models/all-MiniLM-L6-v2"
 CHUNK_SIZE = 700      # characters per chunk
 CHUNK_OVERLAP = 150   # overlap between chunks
 
+# Embedding config
+ENCODE_FLUSH = 512    # chunks embedded + inserted (one executemany) per flush
+ENCODE_BATCH = 64     # chunks per forward pass
 
-def get_chunks(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+
+def get_chunk_spans(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     """
-    Split long text into overlapping chunks.
-    Normalizes whitespace and uses a sliding window.
+    Normalize whitespace and split into overlapping windows.
+    Returns (normalized_text, [(start, end), ...]) character spans.
     """
     text = text.replace("\r", " ").replace("\n", " ")
     text = " ".join(text.split())  # collapse multiple spaces
-    chunks = []
-    start = 0
     length = len(text)
+    if not length:
+        return text, []
 
-    while start < length:
-        end = min(start + chunk_size, length)
-        chunk = text[start:end]
-        if chunk.strip():
-            chunks.append(chunk)
-        if end == length:
-            break
-        start = start + chunk_size - overlap
+    # After the collapse no window is whitespace-only, so no strip() check.
+    # Starts stop once a window has reached the end of the text.
+    step = chunk_size - overlap
+    spans = [
+        (start, min(start + chunk_size, length))
+        for start in range(0, max(length - overlap, 1), step)
+    ]
+    return text, spans
 
-    return chunks
+
+def get_chunks(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Split long text into overlapping chunks.
+    Normalizes whitespace and uses a sliding window.
+    """
+    text, spans = get_chunk_spans(text, chunk_size, overlap)
+    return [text[start:end] for start, end in spans]
+
+
+def extract_chunks(pdf_path):
+    """
+    Extract and chunk every page of one PDF.
+    Runs in a worker process; returns [(source, page, page_text, spans), ...]
+    with spans as in get_chunk_spans().
+    """
+    pdf_path = Path(pdf_path)
+    rows = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(len(doc)):
+            text = doc[page_num].get_text("text")
+
+            if not text or not text.strip():
+                continue
+
+            text, spans = get_chunk_spans(text)
+            if spans:
+                rows.append((pdf_path.name, page_num + 1, text, spans))
+    return rows
 
 
 def create_db():
     """
     Create (or open) the SQLite database and ensure the docs table exists.
-    Embeddings are stored as JSON text (no extensions needed).
+    Embeddings are stored as raw float32 bytes (no extensions needed).
     """
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
     con = sqlite3.connect(DB_PATH)
 
+    # Bulk-load settings: the whole run is one transaction, so there is
+    # no need to fsync on every statement.
+    con.execute("PRAGMA journal_mode=WAL;")
+    con.execute("PRAGMA synchronous=NORMAL;")
+    con.execute("PRAGMA temp_store=MEMORY;")
+    con.execute("PRAGMA cache_size=-65536;")  # 64 MB page cache
+
     con.execute("""
         CREATE TABLE IF NOT EXISTS docs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             source TEXT,
             page INTEGER,
             text TEXT,
-            embedding TEXT            -- JSON string of the vector
+            embedding BLOB,           -- float32 vector, np.ndarray.tobytes()
+            dim INTEGER               -- vector length
         );
     """)
+
+    # Older indexes stored JSON text and had no `dim` column
+    cols = [row[1] for row in con.execute("PRAGMA table_info(docs);")]
+    if "dim" not in cols:
+        con.execute("ALTER TABLE docs ADD COLUMN dim INTEGER;")
+
     con.commit()
     return con
 
 
+def tokenize_page(model, text, spans):
+    """
+    Tokenize a whole page once and cut the token ids of each chunk out of it,
+    so the overlap between neighbouring chunks isn't tokenized twice.
+
+    Windows are character based and usually cut a word at each edge. Slicing
+    the page tokens there would start a chunk with orphaned "##" pieces, so a
+    chunk takes the page tokens of the words that lie completely inside it,
+    and the two cut-off fragments at its edges are tokenized on their own.
+    WordPiece tokenizes each word independently, so the result is the same
+    ids model.encode would get from the chunk text.
+    """
+    tokenizer = model.tokenizer
+    enc = tokenizer(
+        text,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        verbose=False,  # pages are longer than max_seq_length, chunks aren't
+    )
+    ids = enc["input_ids"]
+
+    # Per pre-tokenized word: character span and token range on the page
+    word_starts, word_ends, word_first, word_last = [], [], [], []
+    prev_word = None
+    for tok, (word, (start, end)) in enumerate(zip(enc.word_ids(), enc["offset_mapping"])):
+        if word != prev_word:
+            word_starts.append(start)
+            word_ends.append(end)
+            word_first.append(tok)
+            word_last.append(tok)
+            prev_word = word
+        else:
+            word_ends[-1] = end
+            word_last[-1] = tok
+
+    # (head, middle token range, tail) per chunk; edge fragments batched below
+    parts = []
+    fragments = []
+    for start, end in spans:
+        lo = bisect_left(word_starts, start)      # first word starting inside
+        hi = bisect_right(word_ends, end) - 1     # last word ending inside
+        if lo <= hi:
+            head, tail = text[start:word_starts[lo]], text[word_ends[hi]:end]
+            middle = (word_first[lo], word_last[hi] + 1)
+        else:
+            head, tail, middle = text[start:end], "", (0, 0)
+        parts.append((len(fragments), middle))
+        fragments.extend((head, tail))
+
+    frag_ids = tokenizer(fragments, add_special_tokens=False)["input_ids"] if fragments else []
+    max_tokens = model.max_seq_length - 2  # room for [CLS] / [SEP]
+
+    return [
+        (frag_ids[f] + ids[m_lo:m_hi] + frag_ids[f + 1])[:max_tokens]
+        for f, (m_lo, m_hi) in parts
+    ]
+
+
+def encode_token_ids(model, id_lists):
+    """
+    Embed pre-tokenized chunks (no special tokens) -> normalized float32 [N, D].
+    Same pipeline as model.encode (transformer + pooling), minus tokenization.
+    """
+    tokenizer = model.tokenizer
+    # Length-sorted batches keep padding to a minimum
+    order = sorted(range(len(id_lists)), key=lambda i: len(id_lists[i]))
+    embs = np.empty((len(id_lists), model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    for b in range(0, len(order), ENCODE_BATCH):
+        batch_idx = order[b:b + ENCODE_BATCH]
+        # [CLS] ids [SEP], spelled out: build_inputs_with_special_tokens is gone in transformers 5
+        seqs = [[tokenizer.cls_token_id, *id_lists[i], tokenizer.sep_token_id] for i in batch_idx]
+        width = max(len(seq) for seq in seqs)
+        input_ids = torch.full((len(seqs), width), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(seqs), width), dtype=torch.long)
+        for row, seq in enumerate(seqs):
+            input_ids[row, :len(seq)] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[row, :len(seq)] = 1
+
+        features = {
+            "input_ids": input_ids.to(model.device),
+            "attention_mask": attention_mask.to(model.device),
+        }
+        with torch.inference_mode():
+            out = model(features)["sentence_embedding"]
+        embs[batch_idx] = out.float().cpu().numpy()
+
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True) + 1e-8
+    return embs
+
+
+def flush_chunks(con, model, pending):
+    """
+    Embed the collected (source, page, chunk, token_ids) rows in batched
+    forward passes and insert them.
+    """
+    if not pending:
+        return
+    embs = encode_token_ids(model, [ids for _, _, _, ids in pending])
+    con.executemany(
+        "INSERT INTO docs (source, page, text, embedding, dim) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [
+            (source, page, chunk, emb.tobytes(), emb.shape[0])
+            for (source, page, chunk, _), emb in zip(pending, embs)
+        ],
+    )
+    pending.clear()
+
+
+def export_matrix(con):
+    """
+    Dump every indexed chunk to MATRIX_PATH (.npy) + META_PATH (JSON lines),
+    row-aligned, so the app can np.load(..., mmap_mode="r") instead of
+    reading the whole table at startup. The first META_PATH line is a header
+    with the DB's db_fingerprint (the app ignores the files once the DB no
+    longer matches it) and the FAISS index type written to FAISS_PATH (null if none).
+    """
+    texts, meta, mat = read_docs(con)
+    if not texts:
+        return
+
+    kind = export_faiss_index(mat)
+
+    tmp_matrix = MATRIX_PATH + ".tmp.npy"
+    np.save(tmp_matrix, mat)
+    tmp_meta = META_PATH + ".tmp"
+    with open(tmp_meta, "w", encoding="utf-8") as f:
+        header = {"format": 1, "db": db_fingerprint(con), "dim": mat.shape[1], "faiss": kind}
+        f.write(json.dumps(header))
+        f.write("\n")
+        for m, text in zip(meta, texts):
+            f.write(json.dumps({**m, "text": text}, ensure_ascii=False))
+            f.write("\n")
+    os.replace(tmp_matrix, MATRIX_PATH)
+    os.replace(tmp_meta, META_PATH)
+    print(f"Exported {mat.shape[0]} x {mat.shape[1]} embedding matrix to {MATRIX_PATH}")
+
+
+def export_faiss_index(mat):
+    """
+    Build the app's FAISS index (rag_index.build_faiss_index) over the
+    exported matrix and write it to FAISS_PATH; the app opens it memory-mapped
+    instead of building a copy in RAM at startup. Returns the index type, or
+    None if faiss isn't installed.
+    """
+    if faiss is None:
+        # an index from an older run would no longer line up with the matrix
+        if os.path.exists(FAISS_PATH):
+            os.remove(FAISS_PATH)
+        return None
+
+    index = build_faiss_index(mat)
+    tmp_index = FAISS_PATH + ".tmp"
+    faiss.write_index(index, tmp_index)
+    os.replace(tmp_index, FAISS_PATH)
+    print(f"Wrote FAISS index ({index.ntotal} vectors) to {FAISS_PATH}")
+    return faiss_index_kind(mat.shape[0])
+
+
 def index_pdfs():
     """
     Main indexing pipeline:
     - Find all PDFs in data/pdfs
-    - Extract text per page
-    - Chunk text
-    - Embed with local MiniLM model
-    - Store in db/rag.db as JSON-encoded embeddings
+    - Extract text per page and chunk it (one worker process per PDF)
+    - Tokenize each page once and embed its chunks with local MiniLM
+    - Store in db/rag.db as float32 BLOB embeddings
+    - Export db/rag.f32.npy + db/rag.meta.jsonl (+ db/rag.faiss) for fast app startup
     """
     pdf_dir = Path(DATA_DIR)
     if not pdf_dir.exists():
         raise FileNotFoundError(f"{DATA_DIR} folder does not exist. Create it and add some PDFs.")
 
-    # Load local embedding model
-    print(f"Loading embedding model from {EMBED_MODEL_PATH} ...")
-    model = SentenceTransformer(EMBED_MODEL_PATH)
+    # Load local embedding model (GPU if available, all CPU cores otherwise)
+    torch.set_num_threads(os.cpu_count() or 1)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Loading embedding model from {EMBED_MODEL_PATH} on {device} ...")
+    model = SentenceTransformer(EMBED_MODEL_PATH, device=device)
 
     con = create_db()
 
@@ -86,33 +310,35 @@ def index_pdfs():
         print(f"No PDFs found in {DATA_DIR}. Add your PDF files and rerun.")
         return
 
-    for pdf_path in pdf_files:
-        print(f"\nIndexing: {pdf_path.name}")
-        doc = fitz.open(pdf_path)
-
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text("text")
-
-            if not text or not text.strip():
-                continue
-
-            chunks = get_chunks(text)
-            print(f"  Page {page_num + 1}: {len(chunks)} chunks")
-
-            for chunk in chunks:
-                emb = model.encode(chunk).tolist()
-                emb_json = json.dumps(emb)  # store as JSON text
-
-                con.execute(
-                    "INSERT INTO docs (source, page, text, embedding) "
-                    "VALUES (?, ?, ?, ?)",
-                    (pdf_path.name, page_num + 1, chunk, emb_json)
-                )
+    pending = []  # (source, page, chunk, token_ids) waiting to be embedded
 
+    # Single transaction for the whole run: one commit (and fsync) at the end
+    # instead of one per PDF. A failed run rolls back and adds no partial rows.
+    con.execute("BEGIN")
+    try:
+        # PDFs are extracted/chunked in parallel worker processes while this
+        # process embeds and inserts whatever has already come back.
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+            for pdf_path, pages in zip(pdf_files, ex.map(extract_chunks, pdf_files)):
+                n_chunks = sum(len(spans) for _, _, _, spans in pages)
+                print(f"Indexing: {pdf_path.name} ({n_chunks} chunks)")
+                for source, page, text, spans in pages:
+                    token_ids = tokenize_page(model, text, spans)
+                    pending.extend(
+                        (source, page, text[start:end], ids)
+                        for (start, end), ids in zip(spans, token_ids)
+                    )
+                    if len(pending) >= ENCODE_FLUSH:
+                        flush_chunks(con, model, pending)
+        flush_chunks(con, model, pending)
         con.commit()
+        export_matrix(con)
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.close()
 
-    con.close()
     print("\n✅ Indexing complete. Embeddings stored in db/rag.db")
 
 
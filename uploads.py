@@ -0,0 +1,76 @@
+import os
+import hashlib
+import binascii
+import tempfile
+
+try:
+    # SIMD base64 decoder, same API as the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# Uploaded images are stored under Dash's assets folder so they are served
+# (and cached by the browser) as static files. If you override UPLOAD_DIR,
+# keep it at assets/uploads relative to the app or the URLs won't resolve.
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "assets/uploads")
+UPLOAD_URL_PREFIX = "/assets/uploads"
+
+_EXT_BY_MIME = {
+    "image/jpeg": "jpg",
+    "image/jpg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+    "image/bmp": "bmp",
+}
+
+
+def is_data_url(value) -> bool:
+    return isinstance(value, str) and value.startswith("data:")
+
+
+def split_data_url(data_url: str):
+    """
+    "data:image/png;base64,AAAA" -> ("image/png", "AAAA").
+    A bare base64 string (no prefix) is returned with mime None.
+    """
+    # partition: one search for the comma and no intermediate list
+    header, sep, b64_str = data_url.partition(",")
+    if not sep:
+        return None, data_url
+    mime = header[len("data:"):].partition(";")[0] if header.startswith("data:") else None
+    return mime or None, b64_str
+
+
+def decode_data_url(data_url: str) -> bytes:
+    """Raw bytes of a dcc.Upload 'contents' string (prefix optional)."""
+    _, b64_str = split_data_url(data_url)
+    return base64.b64decode(b64_str, validate=False)
+
+
+def save_image_preview(data_url: str):
+    """
+    Write an uploaded image to UPLOAD_DIR once (named by its sha1) and
+    return its URL, e.g. "/assets/uploads/<sha1>.png".
+    Returns None if the payload can't be decoded.
+    """
+    mime, _ = split_data_url(data_url)
+    try:
+        img_bytes = decode_data_url(data_url)
+    except (binascii.Error, ValueError):
+        return None
+    if not img_bytes:
+        return None
+
+    digest = hashlib.sha1(img_bytes).hexdigest()
+    filename = f"{digest}.{_EXT_BY_MIME.get(mime, 'img')}"
+    path = os.path.join(UPLOAD_DIR, filename)
+
+    if not os.path.exists(path):
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(img_bytes)
+        os.replace(tmp_path, path)
+
+    return f"{UPLOAD_URL_PREFIX}/{filename}"